@@ -1,7 +1,7 @@
-# Run main.py in parallel. This wrapper script is necessary because turicreate
-# - the clustering library that we use for DBSCAN - does not play well with
-# Python's multiprocessing library. Thus, we need to do job management outside
-# of Python.
+# Run main.py in parallel, writing a separate output file for each user. Note
+# that main.py can also process users in parallel by itself (see its -j
+# option) when a single output file is wanted; each main.py started here is
+# limited to a single process.
 #
 # Usage: ./main-mp.sh [-j JOBS] user-ids.txt database.db [extra.db [...]]
 #
@@ -34,7 +34,7 @@ process_user() {
 
     if ! [ -f "$output_file" ]; then
         echo starting $user
-        ./main.py -i ${user} -o "${output_file}" "$@"
+        ./main.py -j 1 -i ${user} -o "${output_file}" "$@"
     else
         echo skipping $user
     fi
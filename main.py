@@ -3,14 +3,18 @@
 locations determined by DBSCAN* """
 
 import csv
+import itertools
+import math
+import multiprocessing
 import os
 import sqlite3
 import typing
 
+import numpy
 import pandas
 import tqdm
 
-from twitter_homes import measures, db
+from twitter_homes import measures, db, dbscan
 
 # expected keys in the output of run_all_measures(). we can determine this
 # dynamically but it can get very expensive
@@ -22,11 +26,138 @@ OUTPUT_HEADERS = [
     "most_recent_name", "n_tweets", "n_tweets_in_ma", "unique_days", "user_id"
 ]
 
+# maximum number of users whose tweets are fetched from the database in a
+# single query
+USER_BATCH_SIZE = 256
+
+# when running in parallel, the users are split into at least this many
+# batches per worker, so that all workers get work and finish close together
+TASKS_PER_WORKER = 4
+
+# number of results to collect before writing them to the output file
+OUTPUT_BATCH_SIZE = 256
+
+SQL_USER_IDS_INIT = "CREATE TEMP TABLE IF NOT EXISTS uids(id INTEGER PRIMARY KEY)"
+# CROSS JOIN pins uids as the outer loop so that each user is a seek into the
+# covering index on geotweets; only the columns used by the measures are read
+SQL_USER_TWEETS = """
+    SELECT {columns} FROM uids
+    CROSS JOIN geotweets g ON g.user_id = uids.id
+    ORDER BY uids.id, g.rowid
+""".format(columns=", ".join("g." + column for column in db.SQL_COLUMNS))
+
+def chunked(iterable: typing.Iterable,
+            size: int) -> typing.Iterator[list]:
+    """ Split an iterable into lists of at most `size` items.
+
+    Args:
+        iterable: The iterable to split.
+        size: The maximum number of items in each list.
+
+    Returns:
+        A generator yielding lists of items.
+    """
+
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def read_users_tweets(geotweets_db: typing.Union[sqlite3.Connection, db.MultiSqlite],
+                      user_ids: typing.List[int]
+                      ) -> typing.Iterator[pandas.core.frame.DataFrame]:
+    """ Fetch the tweets of several users with a single query.
+
+    The user IDs are loaded into a temporary table which is then joined
+    against the geotweets table, so that all users are served by one scan of
+    the user_id index rather than one query each.
+
+    Args:
+        geotweets_db: The connection to query.
+        user_ids: The IDs of the users to fetch tweets for.
+
+    Returns:
+        A generator yielding one DataFrame of tweets per user that has any.
+    """
+
+    geotweets_db.execute(SQL_USER_IDS_INIT)
+    geotweets_db.execute("DELETE FROM uids")
+    geotweets_db.executemany(
+        "INSERT OR IGNORE INTO uids(id) VALUES (?)",
+        [(user_id,) for user_id in user_ids]
+    )
+
+    tweets_df = pandas.read_sql_query(SQL_USER_TWEETS, geotweets_db)
+
+    # filling uids implicitly opened a transaction, which would otherwise keep
+    # the databases locked against writers for as long as they are connected
+    geotweets_db.commit()
+    for _, user_tweets_df in tweets_df.groupby("user_id", sort=False):
+        yield user_tweets_df.reset_index(drop=True)
+
+# connection used by init_worker() and run_users() within each process
+_geotweets_db: typing.Union[sqlite3.Connection, db.MultiSqlite, None] = None
+
+def init_worker(db_paths: typing.Union[str, typing.List[str]],
+                dbscan_jobs: int = dbscan.N_JOBS) -> None:
+    """ Open this process's own read-only connection to the databases.
+
+    Args:
+        db_paths: The databases to connect to.
+        dbscan_jobs: The number of threads DBSCAN may use in this process.
+    """
+    #pylint: disable=global-statement
+
+    global _geotweets_db
+    if len(db_paths) == 1:
+        _geotweets_db = db.connect_read_only(db_paths[0])
+    else:
+        _geotweets_db = db.MultiSqlite(db_paths, read_only=True)
+    dbscan.N_JOBS = dbscan_jobs
+
+def close_worker() -> None:
+    """ Close the connection opened by init_worker(), if any. """
+    #pylint: disable=global-statement
+
+    global _geotweets_db
+    if isinstance(_geotweets_db, db.MultiSqlite):
+        _geotweets_db.close_all(commit=False)
+    elif _geotweets_db is not None:
+        _geotweets_db.close()
+    _geotweets_db = None
+
+def run_users(user_ids: typing.List[int]) -> typing.Tuple[int, typing.List[dict]]:
+    """ Calculate aggregate measures for a batch of users, using the connection
+    opened by init_worker().
+
+    Args:
+        user_ids: The IDs of the users to process.
+
+    Returns:
+        A tuple of the number of users in the batch and a list of results for
+        the users that have any tweets.
+    """
+
+    if _geotweets_db is None:
+        raise RuntimeError("run_users() called before init_worker()")
+
+    results = []
+    for user_tweets_df in read_users_tweets(_geotweets_db, user_ids):
+        result = run_all_measures(user_tweets_df)
+        if result:
+            results.append(result)
+    return (len(user_ids), results)
+
 def run_all_measures(user_tweets_df: pandas.core.frame.DataFrame,
-                     measures_: typing.List[typing.Callable] = measures.ALL_MEASURES
+                     measures_: typing.Sequence[typing.Callable] = measures.ALL_MEASURES
                      ) -> dict:
     """ Calculate aggregates measures.
 
+    Tweet creation times are parsed once up front and stored in
+    user_tweets_df, so that the measures needing them can share the result.
+
     Args:
         user_tweets_df: A DataFrame containing Twitter data.
         measures_: A list of functions that return aggregate measures from df,
@@ -36,56 +167,105 @@ def run_all_measures(user_tweets_df: pandas.core.frame.DataFrame,
         A dict of calculated aggregate measures.
     """
 
+    user_tweets_df[dbscan.DT_UTC_COLUMN] = dbscan.parse_created_at(
+        user_tweets_df
+    )
+
     results: typing.Dict[str, typing.Union[str, int, float]] = {}
     for measure in measures_:
         return_value = measure(user_tweets_df)
         if not isinstance(return_value, dict):
             return_value = {measure.__name__: return_value}
-        results = {**results, **return_value}
+        results.update(return_value)
     return results
 
 def main(db_paths: typing.Union[str, typing.List[str]],
          user_ids: typing.Iterable[int],
-         output_file: str) -> None:
-    """ Process users and write them to an output file """
+         output_file: str,
+         jobs: typing.Optional[int] = None) -> None:
+    """ Process users and write them to an output file
+
+    Args:
+        db_paths: The databases to query.
+        user_ids: The IDs of the users to process.
+        output_file: The CSV file to append results to.
+        jobs: The number of worker processes to use; defaults to the number
+            of CPUs. With a single job, users are processed in this process.
+    """
+
+    # arrays, e.g. from numpy.loadtxt, are converted without going through a
+    # Python object per ID
+    todo_ids = numpy.unique(numpy.asarray(
+        user_ids if isinstance(user_ids, numpy.ndarray) else list(user_ids),
+        dtype=numpy.int64
+    ))
 
     if os.path.isfile(output_file):
         with open(output_file, "r") as input_fp:
-            seen_ids = set(
-                int(row["user_id"])
-                for row in csv.DictReader(input_fp)
-            )
+            seen_ids = numpy.unique(numpy.fromiter(
+                (int(row["user_id"]) for row in csv.DictReader(input_fp)),
+                dtype=numpy.int64
+            ))
             print("skipping {} already-processed users".format(len(seen_ids)))
-            user_ids = set(user_ids) - seen_ids
+            todo_ids = numpy.setdiff1d(todo_ids, seen_ids, assume_unique=True)
     else:
         with open(output_file, "w") as output_fp:
             writer = csv.DictWriter(output_fp, fieldnames=OUTPUT_HEADERS)
             writer.writeheader()
 
-    # for some reason we can't use multiprocessing here because turicreate's
-    # dbscan function doesn't work
     if len(db_paths) == 1:
-        db_connector = sqlite3.connect
-        db_paths = db_paths[0]
         print("using default sqlite3 connector")
     else:
-        db_connector = db.MultiSqlite
         print("using MultiSqlite connector")
 
-    with open(output_file, "a", 1) as output_fp,\
-        db_connector(db_paths) as geotweets_db:
+    if jobs is None:
+        jobs = os.cpu_count() or 1
 
-        writer = csv.DictWriter(output_fp, fieldnames=OUTPUT_HEADERS)
+    # sqlite3 can only bind plain Python integers
+    todo_ids_list = todo_ids.tolist()
+    batch_size = max(1, min(
+        USER_BATCH_SIZE,
+        math.ceil(len(todo_ids_list) / (jobs * TASKS_PER_WORKER))
+    ))
+    user_id_batches = chunked(todo_ids_list, batch_size)
 
-        for user_id in tqdm.tqdm(user_ids, desc="processing users"):
-            user_tweets_df = pandas.read_sql_query(
-                "SELECT * FROM geotweets WHERE user_id = {}".format(user_id),
-                geotweets_db
-            )
-            if len(user_tweets_df) > 0:
-                result = run_all_measures(user_tweets_df)
-                if result:
-                    writer.writerow(result)
+    pool = None
+    batch_results: typing.Iterator[typing.Tuple[int, typing.List[dict]]]
+    if jobs == 1:
+        init_worker(db_paths)
+        batch_results = map(run_users, user_id_batches)
+    else:
+        # each worker clusters single-threaded, since the workers already
+        # occupy every core
+        pool = multiprocessing.Pool(
+            jobs, initializer=init_worker, initargs=(db_paths, 1)
+        )
+        batch_results = pool.imap_unordered(run_users, user_id_batches)
+
+    try:
+        with open(output_file, "a") as output_fp,\
+            tqdm.tqdm(total=len(todo_ids_list), desc="processing users") as progress:
+
+            writer = csv.DictWriter(output_fp, fieldnames=OUTPUT_HEADERS)
+
+            pending_results: typing.List[dict] = []
+            try:
+                for (n_users, results) in batch_results:
+                    pending_results.extend(results)
+                    if len(pending_results) >= OUTPUT_BATCH_SIZE:
+                        writer.writerows(pending_results)
+                        pending_results.clear()
+                        output_fp.flush()
+                    progress.update(n_users)
+            finally:
+                # keep whatever was finished, so that it is skipped next time
+                writer.writerows(pending_results)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        else:
+            close_worker()
 
 if __name__ == "__main__":
     #pylint: disable=invalid-name
@@ -107,12 +287,17 @@ if __name__ == "__main__":
         "-o", "--output", required=True,
         help="the path to the CSV file to save outputs in."
     )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="the number of worker processes to use; defaults to the number"
+             " of CPUs."
+    )
     args = parser.parse_args()
 
+    user_ids: typing.Iterable[int]
     if os.path.isfile(args.input):
-        with open(args.input, "r") as f:
-            user_ids = set(int(line.rstrip()) for line in f)
+        user_ids = numpy.loadtxt(args.input, dtype=numpy.int64, ndmin=1)
     else:
-        user_ids = [args.input]
+        user_ids = [int(args.input)]
 
-    main(args.databases, user_ids, args.output)
+    main(args.databases, user_ids, args.output, args.jobs)
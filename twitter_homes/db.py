@@ -3,13 +3,16 @@ user.id queries. """
 
 from __future__ import annotations
 
-import csv
 import glob
 import gzip
+import io
+import itertools
 import os
+import pathlib
 import sqlite3
 import typing
 
+import pandas
 import tqdm
 
 from . import dbscan
@@ -35,16 +38,115 @@ SQL_INIT = """
     );
 """
 
+# durability is traded for speed while bulk importing; each file is still
+# imported in a single transaction together with its row in the files table,
+# so an interrupted import can safely be re-run
+SQL_BULK_IMPORT_PRAGMAS = """
+    PRAGMA journal_mode = WAL;
+    PRAGMA synchronous = OFF;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA cache_size = -262144;
+    PRAGMA locking_mode = EXCLUSIVE;
+"""
+# the other bulk import pragmas end with the connection, but the journal mode
+# is stored in the database file, and a database left in WAL mode cannot be
+# opened by the mode=ro readers in main.py unless its -shm file exists or can
+# be created
+SQL_DEFAULT_PRAGMAS = """
+    PRAGMA locking_mode = NORMAL;
+    PRAGMA journal_mode = DELETE;
+"""
+
+# number of CSV rows parsed and inserted at once
+INSERT_BATCH_SIZE = 50000
+
+# number of rows that MultiCursor fetches from each cursor at once
+FETCH_BATCH_SIZE = 10000
+
+# read-only connections map the database into memory instead of copying pages
+# through read() calls, and keep a larger page cache
+SQL_READ_ONLY_PRAGMAS = """
+    PRAGMA mmap_size = 34359738368;
+    PRAGMA cache_size = -524288;
+    PRAGMA temp_store = MEMORY;
+"""
+
+# every column is included so that per-user queries never touch the table
+# itself; this also serves plain user_id lookups, replacing idx_user_id
+SQL_INDEX_INIT = """
+    CREATE INDEX idx_user_cover ON geotweets(
+        user_id,
+        created_at,
+        user_name,
+        coordinates_coordinates_0,
+        coordinates_coordinates_1
+    )
+"""
+
 # obtained from https://en.wikipedia.org/wiki/List_of_file_signatures
 COMPRESSED_ARCHIVE_SIGNATURES = {
     b"\x42\x5a\x68": "bz2",
     b"\x1f\x8b": "gzip",
-    b"\xfd\x37\x7a\58\x5a\x00": "xz"
+    b"\xfd\x37\x7a\x58\x5a\x00": "xz"
 }
 MAX_SIGNATURE_LENGTH = max(
     len(signature)
     for signature in COMPRESSED_ARCHIVE_SIGNATURES
 )
+# the first two bytes already tell the signatures apart
+SIGNATURE_PREFIX_LENGTH = 2
+COMPRESSED_ARCHIVE_SIGNATURE_PREFIXES = {
+    signature[:SIGNATURE_PREFIX_LENGTH]: (signature, compression)
+    for signature, compression in COMPRESSED_ARCHIVE_SIGNATURES.items()
+}
+
+class NullByteStripper(io.RawIOBase):
+    """ The NullByteStripper object wraps a binary file object and drops any
+    null bytes from the data read through it, since some of the CSV files
+    contain them and they confuse the CSV parser.
+
+    Attributes:
+        fp: The wrapped binary file object.
+    """
+    def __init__(self, fp: io.BufferedIOBase):
+        """ Initializes NullByteStripper object.
+
+        Args:
+            fp: The binary file object to read from.
+        """
+
+        super().__init__()
+        self.fp = fp
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        """ Read up to len(buffer) bytes, minus null bytes, into buffer.
+
+        Args:
+            buffer: A writable bytes-like object.
+
+        Returns:
+            The number of bytes read, or 0 at the end of the file.
+        """
+
+        while True:
+            data = self.fp.read(len(buffer))
+            if not data:
+                return 0
+            data = data.replace(b"\0", b"")
+            if data:
+                break
+
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self) -> None:
+        """ Close this object and the wrapped file object. """
+
+        self.fp.close()
+        super().close()
 
 class MultiCursor():
     """ The MultiCursor object roughly mimics important parts of the
@@ -55,8 +157,8 @@ class MultiCursor():
         cursors: A generator yielding cursors for the connected databases.
         description: The description of the first cursor, initialized after
             running self.execute().
-        results: A self reference to this class, initialized after running
-            self.execute().
+        results: An iterator over the results of the last query, empty until
+            self.execute() is run.
     """
     def __init__(self, connections: typing.List[sqlite3.Connection]):
         """ Initializes Multicursor object.
@@ -72,9 +174,9 @@ class MultiCursor():
             connection.cursor()
             for connection in connections
         ]
-        self.results = None
+        self.results: typing.Iterator[tuple] = iter(())
 
-    def __iter__(self) -> typing.Iterable:
+    def __iter__(self) -> typing.Iterator[tuple]:
         """ Iterate over results of all connected cursors. """
 
         return self.results
@@ -94,6 +196,22 @@ class MultiCursor():
 
         return list(iter(self))
 
+    def fetchmany(self, size: int = FETCH_BATCH_SIZE) -> typing.List[tuple]:
+        """ Return up to the next `size` results as a list. """
+
+        return list(itertools.islice(iter(self), size))
+
+    def _fetch_batches(self) -> typing.Iterator[typing.List[tuple]]:
+        """ Fetch results from each connected cursor in turn, in batches of
+        FETCH_BATCH_SIZE rows. """
+
+        for cursor in self.cursors:
+            while True:
+                rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+                if not rows:
+                    break
+                yield rows
+
     def execute(self, query: str,
                 values: typing.Union[tuple, None] = None) -> MultiCursor:
         """ Run a query on all connected cursors.
@@ -112,11 +230,27 @@ class MultiCursor():
             else:
                 cursor.execute(query, values)
 
-        self.results = (
-            result
-            for cursor in self.cursors
-            for result in cursor
-        )
+        self.results = itertools.chain.from_iterable(self._fetch_batches())
+        return self
+
+    def executemany(self, query: str,
+                    values: typing.Iterable[tuple]) -> MultiCursor:
+        """ Run a parameterized query against every set of values on all
+        connected cursors.
+
+        Args:
+            query: The SQL query to run.
+            values: The sets of values to supply to the query.
+
+        Returns:
+            This MultiCursor.
+        """
+
+        values = list(values)
+        for cursor in self.cursors:
+            cursor.executemany(query, values)
+
+        self.results = iter(())
         return self
 
 class MultiSqlite():
@@ -131,15 +265,19 @@ class MultiSqlite():
 
     Attributes:
         db_paths: A list of connected databases.
+        read_only: Whether the databases are opened in read-only mode.
         connections: A list of open connections, if any.
     """
 
-    def __init__(self, db_paths: typing.Union[str, list]):
+    def __init__(self, db_paths: typing.Union[str, list],
+                 read_only: bool = False):
         """ Initialize a MultiSqlite object.
 
         Args:
             db_paths: Either a list of paths or a glob pattern pointing to the
                 databases that should be connected.
+            read_only: Toggles whether the databases are opened in read-only
+                mode (see connect_read_only).
         """
 
         if isinstance(db_paths, list):
@@ -149,6 +287,7 @@ class MultiSqlite():
         else:
             raise ValueError
 
+        self.read_only = read_only
         self.connections = []
         self.connect_all()
 
@@ -167,8 +306,9 @@ class MultiSqlite():
     def connect_all(self) -> None:
         """ Connect to all linked databases. """
 
+        connect = connect_read_only if self.read_only else sqlite3.connect
         self.connections = [
-            sqlite3.connect(path)
+            connect(path)
             for path in self.db_paths
         ]
 
@@ -186,6 +326,12 @@ class MultiSqlite():
             connection.close()
         self.connections = []
 
+    def commit(self) -> None:
+        """ Commit the current transaction on all connected databases. """
+
+        for connection in self.connections:
+            connection.commit()
+
     def cursor(self) -> MultiCursor:
         """ Create a new MultiCursor object from this MultiSqlite's
         connected databases. """
@@ -206,6 +352,46 @@ class MultiSqlite():
         cursor.execute(*cursor_args, **cursor_kwargs)
         return cursor
 
+    def executemany(self, *cursor_args, **cursor_kwargs) -> MultiCursor:
+        """ Run a parameterized query repeatedly on all connected databases.
+
+        Args:
+            cursor_args, cursor_kwargs: Passed through to
+                MultiCursor.executemany.
+
+        Returns:
+            A MultiCursor object.
+        """
+
+        cursor = MultiCursor(self.connections)
+        cursor.executemany(*cursor_args, **cursor_kwargs)
+        return cursor
+
+def connect_read_only(path: str) -> sqlite3.Connection:
+    """ Open a read-only connection to a database. Read-only connections can
+    safely be opened by many processes at once.
+
+    Args:
+        path: The path of the database.
+
+    Returns:
+        An sqlite3.Connection object.
+    """
+
+    uri = "{}?mode=ro".format(pathlib.Path(path).absolute().as_uri())
+    connection = sqlite3.connect(uri, uri=True)
+    _configure_ro(connection)
+    return connection
+
+def _configure_ro(connection: sqlite3.Connection) -> None:
+    """ Tune a read-only connection for large sequential reads.
+
+    Args:
+        connection: The connection to configure.
+    """
+
+    connection.executescript(SQL_READ_ONLY_PRAGMAS)
+
 def detect_compression(file: str) -> typing.Union[str, None]:
     """ Detect the compression of a file, if any.
 
@@ -220,9 +406,11 @@ def detect_compression(file: str) -> typing.Union[str, None]:
     with open(file, "rb") as input_fp:
         head = input_fp.read(MAX_SIGNATURE_LENGTH)
 
-    for signature, compression in COMPRESSED_ARCHIVE_SIGNATURES.items():
-        if head.startswith(signature):
-            return compression
+    match = COMPRESSED_ARCHIVE_SIGNATURE_PREFIXES.get(
+        head[:SIGNATURE_PREFIX_LENGTH]
+    )
+    if match is not None and head.startswith(match[0]):
+        return match[1]
     return None
 
 def init_db(paths: typing.Union[str, typing.List[str]],
@@ -253,46 +441,66 @@ def init_db(paths: typing.Union[str, typing.List[str]],
         db.close()
         return
 
-    with db:
-        print("dropping existing index, if any")
-        db.execute("DROP INDEX IF EXISTS idx_user_id")
+    db.executescript(SQL_BULK_IMPORT_PRAGMAS)
+    try:
+        with db:
+            print("dropping existing indexes, if any")
+            db.execute("DROP INDEX IF EXISTS idx_user_id")
+            db.execute("DROP INDEX IF EXISTS idx_user_cover")
+
+        insert_query = "INSERT INTO {table_name}({columns}) VALUES ({placeholders})".format(
+            table_name=SQL_TABLE_NAME,
+            columns=", ".join(column for column in SQL_COLUMNS),
+            placeholders=", ".join("?" for column in SQL_COLUMNS)
+        )
 
-    for path in tqdm.tqdm(paths_to_import, desc="importing files", position=0):
-        filename = os.path.basename(path)
+        for path in tqdm.tqdm(paths_to_import, desc="importing files", position=0):
+            import_file(db, path, insert_query)
 
-        if detect_compression(path) == "gzip":
-            input_fp = gzip.open(path, "rt")
-        else:
-            input_fp = open(path, "r")
+        with db:
+            print("creating new index")
+            db.execute(SQL_INDEX_INIT)
+    finally:
+        db.executescript(SQL_DEFAULT_PRAGMAS)
+        db.close()
 
-        # for some reason some rows have null bytes
-        reader = csv.DictReader(
-            row.replace("\0", "")
-            for row in input_fp
-        )
+def import_file(db: sqlite3.Connection, path: str, insert_query: str) -> None:
+    """ Import a single CSV file into an SQLite database, in one transaction
+    that also records the file in the files table.
 
-        with db:
+    Args:
+        db: The database that the data should be imported into.
+        path: The path to the CSV file to import.
+        insert_query: The INSERT statement to run for each row.
+    """
+    #pylint: disable=invalid-name
+
+    filename = os.path.basename(path)
+
+    raw_fp: io.BufferedIOBase
+    if detect_compression(path) == "gzip":
+        raw_fp = gzip.open(path, "rb")
+    else:
+        raw_fp = open(path, "rb")
+
+    # for some reason some rows have null bytes
+    with io.BufferedReader(NullByteStripper(raw_fp)) as input_fp,\
+        tqdm.tqdm(desc="importing {}".format(filename), unit=" rows",
+                  position=1, leave=None) as progress,\
+        db:
+
+        reader = pandas.read_csv(
+            input_fp,
+            usecols=REQUIRED_COLUMNS,
+            dtype=str,
+            na_filter=False,
+            chunksize=INSERT_BATCH_SIZE
+        )
+        for chunk in reader:
             db.executemany(
-                "INSERT INTO {table_name}({columns}) VALUES ({placeholders})".format(
-                    table_name=SQL_TABLE_NAME,
-                    columns=", ".join(column for column in SQL_COLUMNS),
-                    placeholders=", ".join("?" for column in SQL_COLUMNS)
-                ),
-                (
-                    tuple([row[column] for column in REQUIRED_COLUMNS])
-                    for row in tqdm.tqdm(
-                        reader,
-                        desc="importing {}".format(filename),
-                        position=1,
-                        leave=None
-                    )
-                )
+                insert_query,
+                chunk[REQUIRED_COLUMNS].itertuples(index=False, name=None)
             )
-            db.execute("INSERT INTO files(filename) VALUES (?)", (filename,))
-            input_fp.close()
-
-    with db:
-        print("creating new index")
-        db.execute("CREATE INDEX idx_user_id ON geotweets(user_id)")
+            progress.update(len(chunk))
 
-    db.close()
+        db.execute("INSERT INTO files(filename) VALUES (?)", (filename,))
@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 
-import dateutil.parser
+import functools
+import math
+import numba
 import numpy
 import os
 import pandas
 import pytz
+import sklearn.cluster
 import timezonefinder
-import turicreate
 
-EPS = 0.0004
-MIN_POINTS = 3
+EPS = 0.0004 # degrees of arc
+MIN_POINTS = 3 # neighbors, not counting the point itself
+N_JOBS = -1
 RADIUS_OF_EARTH = 6372800 # meters
 
 VERBOSE = False
@@ -26,6 +29,18 @@ LON_COLUMN = "coordinates_coordinates_0"
 LAT_COLUMN = "coordinates_coordinates_1"
 BURST_TWEETS_GROUPBY_COLUMNS = ["created_at", LON_COLUMN, LAT_COLUMN]
 DBSCAN_CLUSTER_TYPES = ["core", "boundary", "noise"]
+CREATED_AT_FORMAT = "%a %b %d %H:%M:%S %z %Y"
+
+# Column holding created_at already parsed as UTC datetimes, if the caller has
+# added it (see parse_created_at)
+DT_UTC_COLUMN = "_dt_utc"
+
+# Size, in degrees, of the grid cells that share a single timezone lookup
+TZ_GRID_SIZE = 0.1
+
+# Timezone lookups are cached on coordinates rounded to this many decimals
+TZ_CACHE_PRECISION = 2
+TZ_CACHE_SIZE = 4096
 
 def print_verbose(str_):
     if (VERBOSE):
@@ -37,14 +52,27 @@ def merge_dicts(*dicts):
         new_dict.update(dict_)
     return new_dict
 
+def parse_created_at(tweets_df):
+    if (DT_UTC_COLUMN in tweets_df):
+        return tweets_df[DT_UTC_COLUMN]
+    return pandas.to_datetime(
+        tweets_df["created_at"], format = CREATED_AT_FORMAT, utc = True
+    )
+
 class DatetimeLocalizer(object):
 
     def __init__(self):
         self.timezones = {}
         self.timezonefinder = timezonefinder.TimezoneFinder()
+        self.timezone_at = functools.lru_cache(maxsize = TZ_CACHE_SIZE)(
+            self.timezonefinder.timezone_at
+        )
 
     def lookup_tz(self, lon, lat):
-        tz_name = self.timezonefinder.timezone_at(lng = lon, lat = lat)
+        tz_name = self.timezone_at(
+            lng = round(lon, TZ_CACHE_PRECISION),
+            lat = round(lat, TZ_CACHE_PRECISION)
+        )
         if (not tz_name in self.timezones):
             try:
                 self.timezones[tz_name] = pytz.timezone(tz_name)
@@ -53,27 +81,76 @@ class DatetimeLocalizer(object):
                 self.timezones[tz_name] = None
         return self.timezones[tz_name]
 
-    def get_localized_dt(self, tweet):
+    def localize(self, tweets_df):
         # TODO: replace with snowflake
-        dt = dateutil.parser.parse(tweet["created_at"])
-        try:
-            tz = self.lookup_tz(*tweet[[LON_COLUMN, LAT_COLUMN]])
-            if (tz is None):
-                return dt
-            else:
-                return dt.astimezone(tz)
-        except:
-            return dt
-
-# From https://stackoverflow.com/a/45395941
-def haversine(lat1, lon1, lat2, lon2):
-    dLat = numpy.radians(lat2 - lat1)
-    dLon = numpy.radians(lon2 - lon1)
-    lat1 = numpy.radians(lat1)
-    lat2 = numpy.radians(lat2)
-    a = numpy.sin(dLat/2)**2 + numpy.cos(lat1)*numpy.cos(lat2)*numpy.sin(dLon/2)**2
-    c = 2*numpy.arcsin(numpy.sqrt(a))
-    return RADIUS_OF_EARTH * c
+        dt_utc = parse_created_at(tweets_df)
+
+        # Tweets cluster geographically, so look up the timezone once per grid
+        # cell instead of once per tweet
+        grid_cells = [
+            (tweets_df[column] / TZ_GRID_SIZE).round()
+            for column in [LON_COLUMN, LAT_COLUMN]
+        ]
+        localized = []
+        for (_, cell) in tweets_df.groupby(grid_cells, sort = False,
+                                           dropna = False):
+            cell_dt = dt_utc.loc[cell.index]
+            try:
+                tz = self.lookup_tz(
+                    cell[LON_COLUMN].iloc[0], cell[LAT_COLUMN].iloc[0]
+                )
+            except:
+                tz = None
+            if (tz is not None):
+                cell_dt = cell_dt.dt.tz_convert(tz)
+            localized.append(pandas.DataFrame({
+                "dt": cell_dt,
+                "weekday": cell_dt.dt.weekday,
+                "hour": cell_dt.dt.hour
+            }))
+
+        # Datetimes in different timezones can only share a column as objects
+        if (len(set(str(cell["dt"].dt.tz) for cell in localized)) > 1):
+            for cell in localized:
+                cell["dt"] = cell["dt"].astype(object)
+
+        return pandas.concat(localized).reindex(tweets_df.index)
+
+# Shared between users, so that the timezone data is only loaded once and the
+# timezone lookup cache carries over
+_localizer = None
+
+def get_localizer():
+    global _localizer
+    if (_localizer is None):
+        _localizer = DatetimeLocalizer()
+    return _localizer
+
+# Great-circle distances in meters between arrays of point pairs given in
+# radians, computed in one compiled pass with no temporary arrays. Formula from
+# https://stackoverflow.com/a/45395941
+@numba.njit(
+    "float64[:](float64[:], float64[:], float64[:], float64[:])",
+    fastmath = True, cache = True
+)
+def haversine_pairs(lons1, lats1, lons2, lats2):
+    dists = numpy.empty(lons1.shape[0])
+    for i in range(lons1.shape[0]):
+        d_lat = lats2[i] - lats1[i]
+        d_lon = lons2[i] - lons1[i]
+        a = (
+            math.sin(d_lat/2)**2 +
+            math.cos(lats1[i])*math.cos(lats2[i])*math.sin(d_lon/2)**2
+        )
+        dists[i] = RADIUS_OF_EARTH * 2*math.asin(math.sqrt(a))
+    return dists
+
+# Coordinates of a DataFrame's tweets as a contiguous array of (lat, lon)
+# rows in radians, the layout expected by DBSCAN with the haversine metric
+def radians_coords(df):
+    return numpy.ascontiguousarray(numpy.radians(
+        df[[LAT_COLUMN, LON_COLUMN]].to_numpy(dtype = numpy.float64)
+    ))
 
 def dist_euclidean(x1, y1, x2, y2):
     return numpy.sqrt((y2 - y1)**2 + (x2 - x1)**2)
@@ -92,34 +169,40 @@ def create_output_df(df_clusters):
     df_output["type"] = df_clusters["type"]
     return df_output
 
-def create_cluster_aggregates(df_clusters):
-    clusters = []
-
-    for cluster_id in df_clusters["cluster_id"].unique():
-        this_cluster = df_clusters[df_clusters["cluster_id"] == cluster_id]
-        coordinates = this_cluster[[LON_COLUMN, LAT_COLUMN]]
-        cluster_centroid = coordinates.mean()
-        clusters.append({
-            "cluster_id": cluster_id,
-            "centroid_lon": cluster_centroid[0],
-            "centroid_lat": cluster_centroid[1],
-            "time_range": (
-                this_cluster["dt"].max() - this_cluster["dt"].min()
-            ).total_seconds(),
-            "max_dist_from_centroid": haversine(
-                cluster_centroid[0], cluster_centroid[1],
-                coordinates[LON_COLUMN].values, coordinates[LAT_COLUMN].values
-            ).max()
-        })
+def create_cluster_aggregates(df_clusters, coords = None):
+    # coords, if given, are the radians_coords() of df_clusters
+    if (coords is None):
+        coords = radians_coords(df_clusters)
+
+    clusters = df_clusters.groupby("cluster_id")
+    centroids = clusters[[LON_COLUMN, LAT_COLUMN]].mean()
+
+    # Distance of every point from the centroid of its own cluster
+    centroid_coords = numpy.ascontiguousarray(numpy.radians(
+        centroids.loc[df_clusters["cluster_id"], [LAT_COLUMN, LON_COLUMN]]\
+            .to_numpy(dtype = numpy.float64)
+    ))
+    dist_from_centroid = pandas.Series(
+        haversine_pairs(
+            centroid_coords[:, 1], centroid_coords[:, 0],
+            coords[:, 1], coords[:, 0]
+        ),
+        index = df_clusters.index
+    )
+
+    # Datetimes spanning several timezones are stored as objects, so the time
+    # ranges are coerced back to timedeltas
+    time_range = pandas.to_timedelta(clusters["dt"].max() - clusters["dt"].min())
 
-    # For cluster counts, we merge a df.value_counts() table on its index
-    cluster_aggregates = pandas.merge(
-        pandas.DataFrame(clusters),
-        df_clusters["cluster_id"].value_counts()\
-            .rename_axis("cluster_id").reset_index(name = "count"),
-        on = "cluster_id"
-    ).sort_values("cluster_id").reset_index(drop = True)
-    cluster_aggregates["count"] = cluster_aggregates["count"]
+    cluster_aggregates = pandas.DataFrame({
+        "centroid_lon": centroids[LON_COLUMN],
+        "centroid_lat": centroids[LAT_COLUMN],
+        "time_range": time_range.dt.total_seconds(),
+        "max_dist_from_centroid": dist_from_centroid.groupby(
+            df_clusters["cluster_id"]
+        ).max(),
+        "count": clusters.size()
+    }).rename_axis("cluster_id").reset_index()
 
     return cluster_aggregates
 
@@ -154,9 +237,8 @@ def determine_home_cluster(cluster_aggregates):
     return (None, None)
 
 def dbscan(tweets_df):
-    df = tweets_df.copy()
-    user_id = df.loc[0]["user_id"]
-    localizer = DatetimeLocalizer()
+    user_id = tweets_df["user_id"].iloc[0]
+    localizer = get_localizer()
     dbscan_debug_info = {
         "clustering_attempted": 0
     }
@@ -165,35 +247,37 @@ def dbscan(tweets_df):
         for cluster_type in DBSCAN_CLUSTER_TYPES
     })
 
+    # several worker processes may be creating these at the same time
     for directory in [CLUSTERS_OUTPUT, AGGREGATES_OUTPUT]:
-        if not os.path.isdir(directory):
-            os.makedirs(directory)
+        os.makedirs(directory, exist_ok = True)
 
     ## PREPROCESSING ###########################################################
 
     # Removal of burst tweets
-    n_orig = len(df)
-    df = df.groupby(BURST_TWEETS_GROUPBY_COLUMNS).first().reset_index()
-    n_deduplicated = len(df)
-    dbscan_debug_info["n_burst_tweets"] = n_orig - n_deduplicated
+    burst_tweets = tweets_df.duplicated(subset = BURST_TWEETS_GROUPBY_COLUMNS)
+    dbscan_debug_info["n_burst_tweets"] = int(burst_tweets.sum())
 
     # Localize datetimes
     print_verbose("Localizing datetimes")
-    df["dt"] = df.apply(localizer.get_localized_dt, axis = 1)
+    localized = localizer.localize(tweets_df)
 
     # subset by weekday; datetime weekday:
     #   monday = 0
     #   thursday = 3
     #   so: monday to thursday: weekday <= 3
-    df = df[df["dt"].apply(lambda dt: dt.weekday() <= 3)]
-
+    #
     # subset by hour; datetime hour:
     #   12am: 0
     #   8pm: 9
     #   so: 8pm-11:59:59.99... pm: hour >= 9
-    df = df[df["dt"].apply(lambda dt: dt.hour >= 9)]
+    #
+    # all filters are combined so that the tweets are only copied once
+    home_period = (
+        ~burst_tweets & (localized["weekday"] <= 3) & (localized["hour"] >= 9)
+    )
+    df = tweets_df.loc[home_period].reset_index(drop = True)
+    df["dt"] = localized.loc[home_period, "dt"].array
 
-    df = df.reset_index(drop = True)
     dbscan_debug_info["n_home_period_tweets"] = len(df)
 
     if (len(df) == 0):
@@ -211,18 +295,26 @@ def dbscan(tweets_df):
 
     print_verbose("Starting DBSCAN*")
 
-    # convert pandas DataFrame to turicreate SFrame so we can use turicreate's
-    # dbscan
-    sf = turicreate.SFrame(df[[LON_COLUMN, LAT_COLUMN]])
-
-    # DBSCAN
-    dbscan_model = turicreate.dbscan.create(
-        sf, radius = EPS, min_core_neighbors = MIN_POINTS, verbose = VERBOSE,
-        distance = "euclidean"
+    # DBSCAN, with haversine distances on (lat, lon) in radians
+    coords = radians_coords(df)
+    dbscan_model = sklearn.cluster.DBSCAN(
+        eps = numpy.radians(EPS), min_samples = MIN_POINTS + 1,
+        metric = "haversine", algorithm = "ball_tree", n_jobs = N_JOBS
     )
-
-    # convert results to a dataframe for processing
-    results = dbscan_model["cluster_id"].to_dataframe()
+    labels = dbscan_model.fit_predict(coords)
+
+    # convert results to a dataframe for processing; noise points are the only
+    # ones without a cluster, and any other non-core points are boundary points
+    cluster_types = numpy.full(len(labels), "boundary", dtype = object)
+    cluster_types[labels == -1] = "noise"
+    cluster_types[dbscan_model.core_sample_indices_] = "core"
+    results = pandas.DataFrame({
+        "row_id": numpy.arange(len(labels)),
+        "cluster_id": pandas.Series(labels, dtype = "Int64").where(
+            labels != -1
+        ),
+        "type": cluster_types
+    })
 
     # store information for dbscan type counts
     cluster_type_counts = dict(results["type"].value_counts())
@@ -256,12 +348,13 @@ def dbscan(tweets_df):
 
     # DBSCAN*: Only include core points (no noise or boundary points)
     df_clusters = df_clusters[df_clusters["type"] == "core"]
-    df_clusters["cluster_id"] = df_clusters["cluster_id"].astype(int)
 
     ## CLUSTER AGGREGATE MEASURES ##############################################
 
     print_verbose("Creating cluster aggregate measures")
-    cluster_aggregates = create_cluster_aggregates(df_clusters)
+    cluster_aggregates = create_cluster_aggregates(
+        df_clusters, coords[df_clusters["row_id"].to_numpy()]
+    )
     cluster_aggregates.to_csv(
         "%s/%s.csv" % (AGGREGATES_OUTPUT, user_id), index = False
     )
@@ -4,11 +4,10 @@ Warning: all periods in the CSV files become underscores in the SQLite
 database, in order to conform to proper naming standards.
 """
 
-import inspect
 import os
-import sys
 
 import pandas
+import shapely
 import shapely.wkb
 
 from . import dbscan
@@ -24,6 +23,14 @@ MA_BOUNDS = os.path.join(os.path.dirname(__file__), "data", "massachusetts.wkb")
 with open(MA_BOUNDS, "rb") as f:
     MA_SHAPE = shapely.wkb.load(f)
 
+# shapely 2.0 exposes vectorized predicates at the top level and can prepare
+# geometries in place; older versions only have shapely.vectorized
+SHAPELY_2 = hasattr(shapely, "contains_xy")
+if SHAPELY_2:
+    shapely.prepare(MA_SHAPE)
+else:
+    import shapely.vectorized
+
 def user_id(tweets_df: pandas.core.frame.DataFrame) -> str:
     """ Get the user ID. """
     return tweets_df.iloc[0]["user_id"]
@@ -42,10 +49,13 @@ def n_tweets(tweets_df: pandas.core.frame.DataFrame) -> int:
 
 def n_tweets_in_ma(tweets_df: pandas.core.frame.DataFrame) -> int:
     """ Get the number of tweets appearing within the bounds of Boston. """
-    return tweets_df[LON_LAT_COLUMNS].apply(
-        lambda coords: shapely.geometry.Point(coords).within(MA_SHAPE),
-        axis = 1
-    ).sum()
+    lon = tweets_df[LON_LAT_COLUMNS[0]].to_numpy()
+    lat = tweets_df[LON_LAT_COLUMNS[1]].to_numpy()
+    if SHAPELY_2:
+        in_ma = shapely.contains_xy(MA_SHAPE, lon, lat)
+    else:
+        in_ma = shapely.vectorized.contains(MA_SHAPE, lon, lat)
+    return int(in_ma.sum())
 
 def dbscan_results(tweets_df: pandas.core.frame.DataFrame) -> dict:
     """ Return the results of DBSCAN (see dbscan module for more info) """
@@ -53,16 +63,19 @@ def dbscan_results(tweets_df: pandas.core.frame.DataFrame) -> dict:
 
 def unique_days(tweets_df: pandas.core.frame.DataFrame) -> int:
     """  Return the number of unique days that this user appears on. """
-    return len(
-        tweets_df["created_at"].apply(
-            # First 3 words are: shortened weekday, month, day of month
-            # This is unique for each day
-            lambda date_str: tuple(date_str.split(" ")[:3])
-        ).unique()
-    )
-
-ALL_MEASURES = [
-    obj
-    for (name, obj) in inspect.getmembers(sys.modules[__name__])
-    if callable(obj)
-]
\ No newline at end of file
+    dt = dbscan.parse_created_at(tweets_df).dt
+    # Days are told apart by weekday, month and day of month, as written at
+    # the start of created_at; the year is deliberately not considered
+    return int((
+        (dt.month * 32 + dt.day) * 7 + dt.weekday
+    ).nunique())
+
+ALL_MEASURES = (
+    user_id,
+    most_frequent_name,
+    most_recent_name,
+    n_tweets,
+    n_tweets_in_ma,
+    dbscan_results,
+    unique_days,
+)